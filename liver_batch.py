@@ -0,0 +1,215 @@
+# Column-wise batch scoring. Imported from the batch expander only, so pandas and pyarrow
+# stay out of the single-patient path.
+import threading
+import types
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import liver_kernels
+from liver_kernels import W_NO_NFS, W_WITH_NFS
+from liver_scores import (
+    THRESHOLDS, categorize_fli_vec,
+    subscore_fib4_vec, subscore_apri_vec, subscore_nfs_vec,
+)
+
+# Compiled batch scoring; without numba the same formulas run as NumPy column ops
+try:
+    from numba import njit, prange
+    NUMBA_ENABLED = True
+except Exception:
+    NUMBA_ENABLED = False
+
+# Batch CSV parsing (multi-threaded Arrow reader; streamlit already depends on pyarrow)
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    PYARROW_ENABLED = True
+except Exception:
+    PYARROW_ENABLED = False
+
+BATCH_INPUT_COLS = ["name", "age", "sex", "bmi", "waist_cm", "tg_mgdl", "ggt_ul",
+                    "ast_ul", "alt_ul", "uln_ast", "platelets", "albumin_gdl", "diab_ifg"]
+
+# Lower-cased CSV header -> canonical column name
+CSV_COLUMN_ALIASES = {
+    'name': 'name', 'patientname': 'name',
+    'age': 'age', 'sex': 'sex', 'bmi': 'bmi', 'waist_cm': 'waist_cm', 'waist': 'waist_cm',
+    'tg_mgdl': 'tg_mgdl', 'tg': 'tg_mgdl', 'triglycerides': 'tg_mgdl',
+    'ggt_ul': 'ggt_ul', 'ggt': 'ggt_ul',
+    'ast_ul': 'ast_ul', 'ast': 'ast_ul',
+    'alt_ul': 'alt_ul', 'alt': 'alt_ul',
+    'uln_ast': 'uln_ast',
+    'platelets': 'platelets',
+    'albumin_gdl': 'albumin_gdl', 'albumin': 'albumin_gdl',
+    'diab_ifg': 'diab_ifg', 'diabetes': 'diab_ifg'
+}
+
+# Known schema for the C parser, so numeric columns skip type inference. diab_ifg holds
+# 0/1 or Yes/No spellings, so it is read as text categories and converted by _diab_col.
+CSV_DTYPES = {
+    'age': 'float64', 'bmi': 'float64', 'waist_cm': 'float64', 'tg_mgdl': 'float64', 'ggt_ul': 'float64',
+    'ast_ul': 'float64', 'alt_ul': 'float64', 'uln_ast': 'float64', 'platelets': 'float64',
+    'albumin_gdl': 'float64', 'diab_ifg': 'category', 'sex': 'category',
+}
+CSV_NA_VALUES = ['', 'NA', 'N/A']
+GZIP_MIN_ROWS = 50_000  # results at least this long are offered as .csv.gz
+CSV_CHUNK_ROWS = 200_000  # rows formatted per to_csv chunk, bounding the writer's temporaries
+PREVIEW_ROWS = 1_000  # rows sent to the browser for the on-page table
+
+def _read_csv_arrow(file, dtype: Dict[str, str]) -> pd.DataFrame:
+    arrow_types = {'float64': pa.float64(), 'category': pa.dictionary(pa.int32(), pa.string())}
+    table = pacsv.read_csv(
+        file,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types={c: arrow_types[t] for c, t in dtype.items()},
+            null_values=CSV_NA_VALUES, strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+def _read_csv_tolerant(file, dtype: Dict[str, str]) -> pd.DataFrame:
+    # Numeric columns as text, then coerced: a cell like "<5" becomes NaN instead of failing
+    # the whole read, and the other columns keep their declared types.
+    text_cols = [c for c, t in dtype.items() if t == 'float64']
+    df = pd.read_csv(file, dtype={**dtype, **dict.fromkeys(text_cols, str)}, engine="c", na_values=CSV_NA_VALUES)
+    for c in text_cols:
+        df[c] = pd.to_numeric(df[c], errors="coerce").astype(np.float64)
+    return df
+
+def read_batch_csv(file) -> pd.DataFrame:
+    header = pd.read_csv(file, nrows=0, engine="c").columns
+    # Vectorised strip/lower over the header; unknown columns keep their original name.
+    keys = header.astype(str).str.strip().str.lower()
+    names = [CSV_COLUMN_ALIASES.get(k, c) for k, c in zip(keys, header)]
+    dtype = {c: CSV_DTYPES[n] for c, n in zip(header, names) if n in CSV_DTYPES}
+    file.seek(0)
+    if PYARROW_ENABLED:
+        try:
+            df = _read_csv_arrow(file, dtype)
+        except Exception:
+            # A cell outside the schema (e.g. "<5" in a lab column); the typed C read would
+            # reject it too, so go straight to the tolerant read.
+            file.seek(0)
+            df = _read_csv_tolerant(file, dtype)
+    else:
+        try:
+            df = pd.read_csv(file, dtype=dtype, engine="c", na_values=CSV_NA_VALUES)
+        except (ValueError, TypeError):
+            file.seek(0)
+            df = _read_csv_tolerant(file, dtype)
+    df.columns = names
+    # Two spellings of one field (e.g. "AST" and "ast_ul") map to the same name; keep the first.
+    return df.loc[:, ~df.columns.duplicated()]
+
+# Text spellings accepted in diab_ifg next to 0/1; anything else counts as "no"
+_DIAB_TEXT = {"yes": 1.0, "y": 1.0, "true": 1.0, "no": 0.0, "n": 0.0, "false": 0.0}
+
+def _num_col(df: pd.DataFrame, col: str, default: Optional[float] = None) -> np.ndarray:
+    if col in df.columns:
+        x = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        x = np.full(len(df), np.nan)
+    if default is not None:
+        x = np.where(np.isnan(x), default, x)
+    return x
+
+def _diab_values(s: pd.Series) -> np.ndarray:
+    x = pd.to_numeric(s, errors="coerce")
+    if not pd.api.types.is_numeric_dtype(s):
+        # Yes/No cells: one vectorised lower/map over the column fills what to_numeric couldn't
+        x = x.fillna(s.astype(str).str.strip().str.lower().map(_DIAB_TEXT))
+    return x.fillna(0.0).to_numpy(dtype=np.float64)
+
+def _diab_col(df: pd.DataFrame) -> np.ndarray:
+    if "diab_ifg" not in df.columns:
+        return np.zeros(len(df))
+    s = df["diab_ifg"]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # Only a few distinct spellings: convert the categories, then spread them by code
+        v = _diab_values(pd.Series(s.cat.categories))
+        codes = s.cat.codes.to_numpy()
+        return np.where(codes < 0, 0.0, v[codes])
+    return _diab_values(s)
+
+# The app runs numba on the workqueue threading layer, which aborts on concurrent parallel
+# launches, and every Streamlit session runs in its own thread. So batch jobs from all
+# sessions are scored one at a time; each one already uses all cores.
+_KERNEL_LOCK = threading.Lock()
+
+def _compile_batch_kernel():
+    # numba copies of the liver_kernels functions. They share one globals dict, so each
+    # compiled kernel calls the compiled versions of the others, and prange is numba's. They
+    # compile on first call and are then loaded from numba's on-disk cache.
+    ns = dict(vars(liver_kernels), prange=prange)
+    kernels = [n for n, f in ns.items() if n.endswith("_kernel") and isinstance(f, types.FunctionType)]
+    for name in kernels:
+        jit = njit(parallel=True, cache=True) if name == "batch_kernel" else njit(cache=True)
+        ns[name] = jit(types.FunctionType(ns[name].__code__, ns, name))
+    return ns["batch_kernel"]
+
+batch_kernel = _compile_batch_kernel() if NUMBA_ENABLED else None
+
+def _score_arrays_numba(age, bmi, waist, tg, ggt, ast, alt, uln, plate, alb, diab) -> Tuple[np.ndarray, ...]:
+    # Contiguous writable float64 inputs, so one compiled specialisation serves every call
+    # (pandas can hand back read-only views, which numba types separately).
+    ins = [np.require(x, np.float64, "CW") for x in (age, bmi, waist, tg, ggt, ast, alt, uln, plate, alb, diab)]
+    outs = tuple(np.empty(len(age)) for _ in range(5))
+    with _KERNEL_LOCK:
+        batch_kernel(*ins, *outs)
+    return outs
+
+def _score_arrays_numpy(age, bmi, waist, tg, ggt, ast, alt, uln, plate, alb, diab) -> Tuple[np.ndarray, ...]:
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        ln_tg = np.log(np.where(tg > 0, tg, np.nan))
+        ln_ggt = np.log(np.where(ggt > 0, ggt, np.nan))
+        L = 0.953 * ln_tg + 0.139 * bmi + 0.718 * ln_ggt + 0.053 * waist - 15.745
+        # Logistic sigmoid as exp(-log(1 + e^-L)): no overflow for any L, result already in [0, 100].
+        fli = 100.0 * np.exp(-np.logaddexp(0.0, -L))
+
+        fib4 = np.where((alt > 0) & (plate > 0), (age * ast) / (plate * np.sqrt(alt)), np.nan)
+        apri = np.where((uln > 0) & (plate > 0), (ast / uln) * 100.0 / plate, np.nan)
+        nfs = np.where(alt > 0, -1.675 + 0.037 * age + 0.094 * bmi + 1.13 * diab + 0.99 * (ast / alt)
+                       - 0.013 * plate - 0.66 * alb, np.nan)
+
+    fib4_sub, apri_sub, nfs_sub = subscore_fib4_vec(fib4), subscore_apri_vec(apri), subscore_nfs_vec(nfs)
+
+    # Missing subscores count as 0, as in combine_liver_health; all-missing rows stay NaN.
+    subs = np.nan_to_num(np.column_stack((fib4_sub, apri_sub, nfs_sub)))
+    liver100 = np.where(np.isnan(nfs_sub), subs @ np.array(W_NO_NFS), subs @ np.array(W_WITH_NFS))
+    no_subs = np.isnan(fib4_sub) & np.isnan(apri_sub) & np.isnan(nfs_sub)
+    liver100 = np.where(no_subs, np.nan, np.clip(liver100, 0.0, 100.0))
+    return fli, fib4, apri, nfs, liver100
+
+# The fused numba loop when numba is installed, else the same formulas as NumPy column ops
+_score_arrays = _score_arrays_numba if NUMBA_ENABLED else _score_arrays_numpy
+
+def score_batch(df: pd.DataFrame) -> pd.DataFrame:
+    # Same formulas as the scalar functions, evaluated on whole columns; NaN marks "missing".
+    age, bmi, waist = _num_col(df, "age"), _num_col(df, "bmi"), _num_col(df, "waist_cm")
+    tg, ggt = _num_col(df, "tg_mgdl"), _num_col(df, "ggt_ul")
+    ast, alt = _num_col(df, "ast_ul"), _num_col(df, "alt_ul")
+    uln = _num_col(df, "uln_ast", 40.0)
+    plate = _num_col(df, "platelets", 250.0)
+    alb = _num_col(df, "albumin_gdl")
+    diab = _diab_col(df)
+
+    fli, fib4, apri, nfs, liver100 = _score_arrays(age, bmi, waist, tg, ggt, ast, alt, uln, plate, alb, diab)
+
+    # Categorical columns share one label object per band (int8 codes per row, -1 = NaN).
+    fli_band = categorize_fli_vec(fli)
+    fli_cat = pd.Categorical.from_codes(fli_band, categories=THRESHOLDS["fli"]["labels"])
+    fli_act = pd.Categorical.from_codes(fli_band, categories=THRESHOLDS["fli"]["actions"])
+
+    # Fill the result frame column by column; NaN stays NaN and to_csv writes it as empty.
+    out = df.reindex(columns=BATCH_INPUT_COLS)
+    out["FLI"] = np.round(fli, 1)
+    out["FLI_category"] = fli_cat
+    out["FLI_action"] = fli_act
+    out["FIB4"] = np.round(fib4, 3)
+    out["APRI"] = np.round(apri, 3)
+    out["NFS"] = np.round(nfs, 3)
+    out["LiverHealth100"] = np.round(liver100, 1)
+    return out
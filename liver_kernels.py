@@ -0,0 +1,114 @@
+import math
+
+# Score kernels on plain floats. NaN marks a missing or invalid value and every kernel
+# returns NaN in that case; callers convert NaN to None. This module is pure Python: the
+# single-patient scorers call these functions directly, and liver_batch compiles the same
+# functions with numba for the batch path, so numba is only imported once a batch is scored.
+prange = range  # numba's parallel range in the compiled batch_kernel
+
+
+def sigmoid_kernel(x):
+    # exp of a non-positive argument only, so it can't overflow for any finite x
+    if x >= 0.0:
+        return 1.0 / (1.0 + math.exp(-x))
+    e = math.exp(x)
+    return e / (1.0 + e)
+
+
+def fli_kernel(tg_mgdl, bmi, ggt_ul, waist_cm):
+    if not (tg_mgdl > 0.0 and ggt_ul > 0.0):
+        return math.nan
+    L = 0.953 * math.log(tg_mgdl) + 0.139 * bmi + 0.718 * math.log(ggt_ul) + 0.053 * waist_cm - 15.745
+    return 100.0 * sigmoid_kernel(L)
+
+
+def fib4_kernel(age, ast_ul, alt_ul, platelets):
+    if not (alt_ul > 0.0 and platelets > 0.0):
+        return math.nan
+    return (age * ast_ul) / (platelets * math.sqrt(alt_ul))
+
+
+def apri_kernel(ast_ul, uln_ast, platelets):
+    if not (uln_ast > 0.0 and platelets > 0.0):
+        return math.nan
+    return (ast_ul / uln_ast) * 100.0 / platelets
+
+
+def nfs_kernel(age, bmi, diab_ifg, ast_ul, alt_ul, platelets, albumin_gdl):
+    if not alt_ul > 0.0:
+        return math.nan
+    return -1.675 + 0.037 * age + 0.094 * bmi + 1.13 * diab_ifg + 0.99 * (ast_ul / alt_ul) - 0.013 * platelets - 0.66 * albumin_gdl
+
+
+# Subscore ramps, as (breakpoints, values) for linear interpolation or (cut-offs, values)
+# for steps. liver_scores.THRESHOLDS and the array subscores read these same tuples.
+FIB4_SUBSCORE_RAMP = ((1.3, 2.67), (100.0, 40.0))  # linear 100 -> 40, then 20 from 2.67 on
+FIB4_SUBSCORE_HIGH = (2.67, 20.0)
+APRI_SUBSCORE_RAMP = ((0.5, 1.5, 2.0), (100.0, 60.0, 20.0))
+NFS_SUBSCORE_BOUNDS = (math.nextafter(-1.455, math.inf), 0.676)  # 100 for <= -1.455, 50 below 0.676
+NFS_SUBSCORE_VALUES = (100.0, 50.0, 20.0)
+
+
+def _ramp_kernel(x, xp, fp):
+    # np.interp over a tuple of breakpoints, clamped at both ends, same arithmetic
+    if x <= xp[0]:
+        return fp[0]
+    for j in range(1, len(xp)):
+        if x < xp[j]:
+            return (fp[j] - fp[j - 1]) / (xp[j] - xp[j - 1]) * (x - xp[j - 1]) + fp[j - 1]
+    return fp[len(fp) - 1]
+
+
+def subscore_fib4_kernel(x):
+    if math.isnan(x):
+        return math.nan
+    if x >= FIB4_SUBSCORE_HIGH[0]:
+        return FIB4_SUBSCORE_HIGH[1]
+    return _ramp_kernel(x, FIB4_SUBSCORE_RAMP[0], FIB4_SUBSCORE_RAMP[1])
+
+
+def subscore_apri_kernel(x):
+    if math.isnan(x):
+        return math.nan
+    return _ramp_kernel(x, APRI_SUBSCORE_RAMP[0], APRI_SUBSCORE_RAMP[1])
+
+
+def subscore_nfs_kernel(x):
+    if math.isnan(x):
+        return math.nan
+    i = 0
+    for b in NFS_SUBSCORE_BOUNDS:
+        if x >= b:
+            i += 1
+    return NFS_SUBSCORE_VALUES[i]
+
+
+# Liver Health weights for (FIB-4, APRI, NFS) subscores; without NFS, FIB-4 and APRI carry
+# all of it. numba freezes global tuples into the compiled kernels as constants.
+W_WITH_NFS = (0.5, 0.25, 0.25)
+W_NO_NFS = (0.7, 0.3, 0.0)
+
+
+def combine_kernel(fib4_sub, apri_sub, nfs_sub):
+    # Missing subscores count as 0; NaN only when all three are missing.
+    if math.isnan(fib4_sub) and math.isnan(apri_sub) and math.isnan(nfs_sub):
+        return math.nan
+    f = 0.0 if math.isnan(fib4_sub) else fib4_sub
+    a = 0.0 if math.isnan(apri_sub) else apri_sub
+    if math.isnan(nfs_sub):
+        w, n = W_NO_NFS, 0.0
+    else:
+        w, n = W_WITH_NFS, nfs_sub
+    return max(0.0, min(100.0, w[0] * f + w[1] * a + w[2] * n))
+
+
+# Whole batch in one loop over rows; compiled with parallel=True, prange spreads it over cores.
+def batch_kernel(age, bmi, waist, tg, ggt, ast, alt, uln, plate, alb, diab,
+                 out_fli, out_fib4, out_apri, out_nfs, out_liver):
+    for i in prange(age.shape[0]):
+        out_fli[i] = fli_kernel(tg[i], bmi[i], ggt[i], waist[i])
+        fib4 = fib4_kernel(age[i], ast[i], alt[i], plate[i])
+        apri = apri_kernel(ast[i], uln[i], plate[i])
+        nfs = nfs_kernel(age[i], bmi[i], diab[i], ast[i], alt[i], plate[i], alb[i])
+        out_fib4[i], out_apri[i], out_nfs[i] = fib4, apri, nfs
+        out_liver[i] = combine_kernel(subscore_fib4_kernel(fib4), subscore_apri_kernel(apri), subscore_nfs_kernel(nfs))
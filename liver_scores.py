@@ -0,0 +1,194 @@
+import math
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+
+from liver_kernels import (
+    fli_kernel, fib4_kernel, apri_kernel, nfs_kernel,
+    subscore_fib4_kernel, subscore_apri_kernel, subscore_nfs_kernel,
+    FIB4_SUBSCORE_RAMP, FIB4_SUBSCORE_HIGH, APRI_SUBSCORE_RAMP, NFS_SUBSCORE_BOUNDS, NFS_SUBSCORE_VALUES,
+    W_NO_NFS, W_WITH_NFS,
+)
+
+# Scalar scores for the single-patient view. Inputs are validated and cast here; the
+# arithmetic is in liver_kernels, which the batch path compiles. The scorers are pure, so
+# they are memoised. They live in an imported module because Streamlit re-executes the
+# main script on every rerun, which would hand each rerun fresh (empty) caches.
+
+def _none_if_nan(x: float) -> Optional[float]:
+    return None if math.isnan(x) else x
+
+# One table of cut-offs, labels and report wording per score: the categorisers, the array
+# subscores, the Liver Health banner and the PDF rows all read from it. Category band i
+# holds bounds[i - 1] <= x < bounds[i]; cut-offs that are inclusive on the lower band
+# (FIB-4 <= 1.3, NFS <= 0.675) are nudged to the next float up. The subscore ramps are the
+# tuples the numba kernels compile in, since compiled code can't read this dict.
+_NA_COLOR = "#cccccc"
+_GREEN, _AMBER, _RED = "#2e7d32", "#f9a825", "#c62828"
+
+THRESHOLDS = {
+    "fli": dict(
+        bounds=(30.0, 60.0),
+        colors=(_GREEN, _AMBER, _RED),
+        labels=("Low (fatty liver unlikely)", "Intermediate (cannot rule in/out)", "High (fatty liver likely)"),
+        actions=("Maintain lifestyle; periodic monitoring.",
+                 "Consider ultrasound or repeat after lifestyle optimisation.",
+                 "Proceed to fibrosis staging (NFS, FIB-4, APRI)."),
+    ),
+    "fib4": dict(
+        bounds=(math.nextafter(1.3, math.inf), 2.67),
+        colors=(_GREEN, _AMBER, _RED),
+        labels=("Low (rules out advanced fibrosis)", "Indeterminate", "High (advanced fibrosis likely)"),
+        pdf_text=("Advanced fibrosis unlikely; routine monitoring.",
+                  "Indeterminate; consider elastography (FibroScan).",
+                  "Advanced fibrosis likely; refer to hepatology."),
+        subscore_ramp=FIB4_SUBSCORE_RAMP,
+        subscore_high=FIB4_SUBSCORE_HIGH,
+    ),
+    "apri": dict(
+        bounds=(0.5, 1.0),
+        colors=(_GREEN, _AMBER, _RED),
+        labels=("Low", "Indeterminate", "High"),
+        pdf_text=("Significant fibrosis unlikely.",
+                  "Indeterminate; consider elastography / repeat testing.",
+                  "Advanced fibrosis likely; specialist referral."),
+        subscore_ramp=APRI_SUBSCORE_RAMP,
+    ),
+    "nfs": dict(
+        bounds=(-1.455, math.nextafter(0.675, math.inf)),
+        colors=(_GREEN, _AMBER, _RED),
+        labels=("Low", "Indeterminate", "High"),
+        pdf_text=("Advanced fibrosis unlikely.",
+                  "Indeterminate; consider elastography / specialist assessment.",
+                  "Advanced fibrosis likely; specialist referral."),
+        subscore_bounds=NFS_SUBSCORE_BOUNDS,
+        subscore_values=NFS_SUBSCORE_VALUES,
+    ),
+    # Higher is better here, so the colours run the other way.
+    "liver100": dict(
+        bounds=(60.0, 85.0),
+        colors=(_RED, _AMBER, _GREEN),
+        labels=("High probability of advanced fibrosis — hepatology referral, imaging/workup.",
+                "Indeterminate probability — consider elastography (FibroScan).",
+                "Low probability of advanced fibrosis — routine monitoring."),
+    ),
+}
+
+def band_index(kind: str, x: float) -> int:
+    return bisect_right(THRESHOLDS[kind]["bounds"], x)
+
+@lru_cache(maxsize=1024)
+def fli_score(tg_mgdl, bmi, ggt_ul, waist_cm) -> Optional[float]:
+    try:
+        tg_f, bmi_f, ggt_f, waist_f = float(tg_mgdl), float(bmi), float(ggt_ul), float(waist_cm)
+    except Exception:
+        return None
+    return _none_if_nan(fli_kernel(tg_f, bmi_f, ggt_f, waist_f))
+
+@lru_cache(maxsize=1024)
+def fli_category_action(fli: Optional[float]) -> Tuple[Optional[str], Optional[str], str]:
+    if fli is None:
+        return None, None, _NA_COLOR
+    t, b = THRESHOLDS["fli"], band_index("fli", fli)
+    return t["labels"][b], t["actions"][b], t["colors"][b]
+
+@lru_cache(maxsize=1024)
+def fib4_score(age, ast_ul, alt_ul, platelets) -> Optional[float]:
+    try:
+        return _none_if_nan(fib4_kernel(float(age), float(ast_ul), float(alt_ul), float(platelets)))
+    except Exception:
+        return None
+
+@lru_cache(maxsize=1024)
+def apri_score(ast_ul, uln_ast, platelets) -> Optional[float]:
+    try:
+        return _none_if_nan(apri_kernel(float(ast_ul), float(uln_ast), float(platelets)))
+    except Exception:
+        return None
+
+@lru_cache(maxsize=1024)
+def nfs_score(age, bmi, diab_ifg, ast_ul, alt_ul, platelets, albumin_gdl) -> Optional[float]:
+    try:
+        return _none_if_nan(nfs_kernel(
+            float(age), float(bmi), float(int(diab_ifg)), float(ast_ul), float(alt_ul), float(platelets), float(albumin_gdl)
+        ))
+    except Exception:
+        return None
+
+@lru_cache(maxsize=1024)
+def categorize_fib4(x: Optional[float]) -> Tuple[str, str]:
+    if x is None:
+        return "NA", _NA_COLOR
+    t, b = THRESHOLDS["fib4"], band_index("fib4", x)
+    return t["labels"][b], t["colors"][b]
+
+@lru_cache(maxsize=1024)
+def categorize_apri(x: Optional[float]) -> Tuple[str, str]:
+    if x is None:
+        return "NA", _NA_COLOR
+    t, b = THRESHOLDS["apri"], band_index("apri", x)
+    return t["labels"][b], t["colors"][b]
+
+@lru_cache(maxsize=1024)
+def categorize_nfs(x: Optional[float]) -> Tuple[str, str]:
+    if x is None:
+        return "NA", _NA_COLOR
+    t, b = THRESHOLDS["nfs"], band_index("nfs", x)
+    return t["labels"][b], t["colors"][b]
+
+@lru_cache(maxsize=1024)
+def subscore_fib4(x: Optional[float]) -> Optional[float]:
+    if x is None:
+        return None
+    return _none_if_nan(subscore_fib4_kernel(float(x)))
+
+@lru_cache(maxsize=1024)
+def subscore_apri(x: Optional[float]) -> Optional[float]:
+    if x is None:
+        return None
+    return _none_if_nan(subscore_apri_kernel(float(x)))
+
+@lru_cache(maxsize=1024)
+def subscore_nfs(x: Optional[float]) -> Optional[float]:
+    if x is None:
+        return None
+    return _none_if_nan(subscore_nfs_kernel(float(x)))
+
+# Array versions of the subscores for the NumPy batch path (NaN in, NaN out). FIB-4 and APRI
+# are piecewise-linear, so np.interp evaluates them in one C loop; the scalar versions above
+# stay on the plain-float kernels, which beat wrapping a one-element array.
+_FIB4_RAMP_X, _FIB4_RAMP_Y = (np.array(v) for v in THRESHOLDS["fib4"]["subscore_ramp"])
+_APRI_RAMP_X, _APRI_RAMP_Y = (np.array(v) for v in THRESHOLDS["apri"]["subscore_ramp"])
+_NFS_SUB_VALUES = np.array(THRESHOLDS["nfs"]["subscore_values"])
+
+def subscore_fib4_vec(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    high_from, high = THRESHOLDS["fib4"]["subscore_high"]
+    return np.where(x >= high_from, high, np.interp(x, _FIB4_RAMP_X, _FIB4_RAMP_Y))
+
+def subscore_apri_vec(x: np.ndarray) -> np.ndarray:
+    return np.interp(np.asarray(x, dtype=np.float64), _APRI_RAMP_X, _APRI_RAMP_Y)
+
+def subscore_nfs_vec(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    steps = _NFS_SUB_VALUES[np.searchsorted(THRESHOLDS["nfs"]["subscore_bounds"], x, side="right")]
+    return np.where(np.isnan(x), np.nan, steps)
+
+# Array categorisers for the batch path: int8 band codes into THRESHOLDS[kind]["labels"],
+# -1 for NaN, ready for pd.Categorical.from_codes.
+def _band_codes(x: np.ndarray, kind: str) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    return np.where(np.isnan(x), -1, np.searchsorted(THRESHOLDS[kind]["bounds"], x, side="right")).astype(np.int8)
+
+def categorize_fli_vec(x: np.ndarray) -> np.ndarray:
+    return _band_codes(x, "fli")
+
+@lru_cache(maxsize=1024)
+def combine_liver_health(fib4_sub, apri_sub, nfs_sub) -> Optional[float]:
+    if fib4_sub is None and apri_sub is None and nfs_sub is None:
+        return None
+    w = W_NO_NFS if nfs_sub is None else W_WITH_NFS
+    v = w[0] * (fib4_sub or 0.0) + w[1] * (apri_sub or 0.0) + w[2] * (nfs_sub or 0.0)
+    return max(0.0, min(100.0, v))
@@ -1,160 +1,55 @@
-import math
 import re
 import io
-from typing import Optional, Tuple, Dict
+import importlib
+import importlib.util
+import logging
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 import streamlit as st
-import pandas as pd
 
-# PDF parsing
-try:
-    import pdfplumber
-    PDF_ENABLED = True
-except Exception:
-    PDF_ENABLED = False
+# numba reads its threading layer once, on first import. batch_kernel is launched from
+# Streamlit's script threads, and under TBB (numba's pick when tbb is installed) that keeps
+# the server from exiting, so default to workqueue; the environment can still choose.
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
 
-# PDF creation
-try:
-    from reportlab.lib.pagesizes import A4
-    from reportlab.lib.styles import getSampleStyleSheet
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-    from reportlab.lib import colors
-    REPORTLAB_ENABLED = True
-except Exception:
-    REPORTLAB_ENABLED = False
+from liver_scores import (
+    fli_score, fli_category_action, fib4_score, apri_score, nfs_score,
+    categorize_fib4, categorize_apri, categorize_nfs,
+    subscore_fib4, subscore_apri, subscore_nfs, combine_liver_health,
+    THRESHOLDS, band_index,
+)
 
-st.set_page_config(page_title="Liver Health Assessment (Validated Option A) — PDF Ready", layout="wide")
+# PDF parsing (poppler's pdftotext if installed, else PyMuPDF, else pdfplumber)
+PDFTOTEXT_PATH = shutil.which("pdftotext")
+PDFINFO_PATH = shutil.which("pdfinfo")
 
-# ---------- Utility functions ----------
-def _safe_log(x: Optional[float]) -> Optional[float]:
-    try:
-        if x is None or float(x) <= 0:
-            return None
-        return math.log(float(x))
-    except Exception:
-        return None
+# Only probe for the backends here; they are imported on first use in _extract_pdf_text.
+# PyMuPDF releases before 1.24.3 are importable only under their legacy name, fitz.
+PYMUPDF_MODULE = next((m for m in ("pymupdf", "fitz") if importlib.util.find_spec(m)), None)
+PYMUPDF_ENABLED = PYMUPDF_MODULE is not None
+PDFPLUMBER_ENABLED = importlib.util.find_spec("pdfplumber") is not None
 
-def fli_score(tg_mgdl, bmi, ggt_ul, waist_cm) -> Optional[float]:
-    ln_tg = _safe_log(tg_mgdl)
-    ln_ggt = _safe_log(ggt_ul)
-    if None in (ln_tg, ln_ggt) or tg_mgdl in (None, "") or bmi in (None, "") or waist_cm in (None, ""):
-        return None
-    L = 0.953 * ln_tg + 0.139 * float(bmi) + 0.718 * ln_ggt + 0.053 * float(waist_cm) - 15.745
-    f = (math.exp(L) / (1 + math.exp(L))) * 100.0
-    return max(0.0, min(100.0, f))
-
-def fli_category_action(fli: Optional[float]) -> Tuple[Optional[str], Optional[str], str]:
-    if fli is None:
-        return None, None, "#cccccc"
-    if fli < 30:
-        return "Low (fatty liver unlikely)", "Maintain lifestyle; periodic monitoring.", "#2e7d32"
-    if fli < 60:
-        return "Intermediate (cannot rule in/out)", "Consider ultrasound or repeat after lifestyle optimisation.", "#f9a825"
-    return "High (fatty liver likely)", "Proceed to fibrosis staging (NFS, FIB-4, APRI).", "#c62828"
-
-def fib4_score(age, ast_ul, alt_ul, platelets) -> Optional[float]:
-    try:
-        age, ast_ul, alt_ul, platelets = float(age), float(ast_ul), float(alt_ul), float(platelets)
-        if alt_ul <= 0 or platelets <= 0:
-            return None
-        return (age * ast_ul) / (platelets * math.sqrt(alt_ul))
-    except Exception:
-        return None
+# pdfminer logs per parsed object; when a host framework captures DEBUG logs this can
+# slow extraction by an order of magnitude, and we never read these messages.
+logging.getLogger("pdfminer").setLevel(logging.ERROR)
+logging.getLogger("pdfplumber").setLevel(logging.ERROR)
 
-def apri_score(ast_ul, uln_ast, platelets) -> Optional[float]:
-    try:
-        ast_ul, uln_ast, platelets = float(ast_ul), float(uln_ast), float(platelets)
-        if uln_ast <= 0 or platelets <= 0:
-            return None
-        return (ast_ul / uln_ast) * 100.0 / platelets
-    except Exception:
-        return None
+PDF_ENABLED = bool(PDFTOTEXT_PATH) or PYMUPDF_ENABLED or PDFPLUMBER_ENABLED
 
-def nfs_score(age, bmi, diab_ifg, ast_ul, alt_ul, platelets, albumin_gdl) -> Optional[float]:
-    try:
-        age, bmi, diab_ifg, ast_ul, alt_ul, platelets, albumin_gdl = (
-            float(age), float(bmi), int(diab_ifg), float(ast_ul), float(alt_ul), float(platelets), float(albumin_gdl)
-        )
-        if alt_ul <= 0:
-            return None
-        return -1.675 + 0.037 * age + 0.094 * bmi + 1.13 * diab_ifg + 0.99 * (ast_ul / alt_ul) - 0.013 * platelets - 0.66 * albumin_gdl
-    except Exception:
-        return None
+# PDF creation (reportlab is imported by build_pdf, the first time a report is made)
+REPORTLAB_ENABLED = importlib.util.find_spec("reportlab") is not None
 
-def categorize_fib4(x: Optional[float]) -> Tuple[str, str]:
-    if x is None:
-        return "NA", "#cccccc"
-    if x <= 1.3:
-        return "Low (rules out advanced fibrosis)", "#2e7d32"
-    if x < 2.67:
-        return "Indeterminate", "#f9a825"
-    return "High (advanced fibrosis likely)", "#c62828"
-
-def categorize_apri(x: Optional[float]) -> Tuple[str, str]:
-    if x is None:
-        return "NA", "#cccccc"
-    if x < 0.5:
-        return "Low", "#2e7d32"
-    if x < 1.0:
-        return "Indeterminate", "#f9a825"
-    return "High", "#c62828"
-
-def categorize_nfs(x: Optional[float]) -> Tuple[str, str]:
-    if x is None:
-        return "NA", "#cccccc"
-    if x < -1.455:
-        return "Low", "#2e7d32"
-    if x <= 0.675:
-        return "Indeterminate", "#f9a825"
-    return "High", "#c62828"
-
-def subscore_fib4(x: Optional[float]) -> Optional[float]:
-    if x is None:
-        return None
-    if x <= 1.3:
-        return 100.0
-    if x < 2.67:
-        return max(40.0, 100.0 - (x - 1.3) * (60.0 / (2.67 - 1.3)))
-    return 20.0
-
-def subscore_apri(x: Optional[float]) -> Optional[float]:
-    if x is None:
-        return None
-    if x <= 0.5:
-        return 100.0
-    if x <= 1.5:
-        return max(60.0, 100.0 - (x - 0.5) * 40.0)
-    if x <= 2.0:
-        return max(20.0, 60.0 - (x - 1.5) * (40.0 / 0.5))
-    return 20.0
-
-def subscore_nfs(x: Optional[float]) -> Optional[float]:
-    if x is None:
-        return None
-    if x <= -1.455:
-        return 100.0
-    if x < 0.676:
-        return 50.0
-    return 20.0
-
-def combine_liver_health(fib4_sub, apri_sub, nfs_sub) -> Optional[float]:
-    if fib4_sub is None and apri_sub is None and nfs_sub is None:
-        return None
-    if nfs_sub is None:
-        fib = fib4_sub or 0.0
-        apr = apri_sub or 0.0
-        return max(0.0, min(100.0, 0.7 * fib + 0.3 * apr))
-    return max(0.0, min(100.0, 0.5 * (fib4_sub or 0.0) + 0.25 * (apri_sub or 0.0) + 0.25 * (nfs_sub or 0.0)))
+st.set_page_config(page_title="Liver Health Assessment (Validated Option A) — PDF Ready", layout="wide")
+
+# ---------- Utility functions ----------
+_BOX_TMPL = '<div style="background:{c};padding:12px;border-radius:8px;color:white;font-weight:600;">{t}</div>'
 
 def color_box(text: str, color: str):
-    st.markdown(
-        f"""
-        <div style="background:{color};padding:12px;border-radius:8px;color:white;font-weight:600;">
-            {text}
-        </div>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(_BOX_TMPL.format(c=color, t=text), unsafe_allow_html=True)
 
 # ---- Safety clamp for values coming from PDF/session ----
 
@@ -217,55 +112,172 @@ LOOSE_PATTERNS = {
     "age": r"(?:Age)[^\d]{0,20}(\d{1,3})",
 }
 
+# Compiled once at import instead of on every re.search call during a parse.
+_STRICT_RE = {k: re.compile(p, re.I) for k, p in STRICT_PATTERNS.items()}
+_LOOSE_RE = {k: re.compile(p, re.I) for k, p in LOOSE_PATTERNS.items()}
+_ULN_RANGE_RE = [
+    re.compile(r"(?:AST|SGOT)[^\n]*?U/?L[^\n]*?(\d{1,3})\s*[-–‐]\s*(\d{2,3})", re.I),  # ...U/L ... 3 - 50
+    re.compile(r"(?:AST|SGOT)[^\n]*?(?:ref(?:erence)?\s*(?:range|interval)|bio\.?\s*ref.*?|range)[^\n]*?(\d{1,3})\s*[-–‐]\s*(\d{2,3})", re.I),
+]
+_ALBUMIN_UNIT_RE = re.compile(r"Albumin[^\n]{0,40}?(\d+(?:\.\d+)?)\s*(g/?dL|g/?L)", re.I)
+
+# Lab panels sit on the first pages: extract those first and only read further if labs are
+# missing, and don't run the regexes over the rest of huge documents.
+_FIRST_PAGES = 5
+_MAX_SCAN_CHARS = 200_000
+# Name, sex and age come from the report header; if the first pages lack them, later pages
+# won't have them either, so only missing labs are worth reading further for.
+_LAB_FIELDS = tuple(k for k in STRICT_PATTERNS if k not in ("name", "sex", "age"))
+
+
+# PyMuPDF is not thread-safe and pdfplumber is pure Python, so only the pdftotext
+# tier is parallelised: each worker thread waits on its own subprocess.
+_PDFTOTEXT_WORKERS = 4
+_PDFTOTEXT_MIN_PAGES_PER_WORKER = 5
+
+
+def _run_pdftotext(data: bytes, first: Optional[int] = None, last: Optional[int] = None) -> str:
+    cmd = [PDFTOTEXT_PATH, "-layout", "-enc", "UTF-8", "-q"]
+    if first is not None:
+        cmd += ["-f", str(first)]
+    if last is not None:
+        cmd += ["-l", str(last)]
+    proc = subprocess.run(cmd + ["-", "-"], input=data, capture_output=True, timeout=10, check=True)
+    return proc.stdout.decode("utf-8", errors="replace")
+
+
+def _pdf_page_count(data: bytes) -> int:
+    if not PDFINFO_PATH:
+        return 0
+    proc = subprocess.run([PDFINFO_PATH, "-"], input=data, capture_output=True, timeout=10, check=True)
+    m = re.search(rb"^Pages:\s*(\d+)", proc.stdout, flags=re.M)
+    return int(m.group(1)) if m else 0
+
+
+def _pdftotext_text(data: bytes, first: int, last: Optional[int], n: int) -> str:
+    if not n:
+        return _run_pdftotext(data, first + 1, last)
+    stop = n if last is None else min(last, n)
+    if stop - first < 2 * _PDFTOTEXT_MIN_PAGES_PER_WORKER:
+        return _run_pdftotext(data, first + 1, stop) if first < stop else ""
+    step = max(_PDFTOTEXT_MIN_PAGES_PER_WORKER, -(-(stop - first) // _PDFTOTEXT_WORKERS))
+    ranges = [(lo, min(lo + step - 1, stop)) for lo in range(first + 1, stop + 1, step)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+        return "".join(ex.map(lambda r: _run_pdftotext(data, *r), ranges))
+
+
+def _extract_pdf_text(data: bytes, first: int = 0, last: Optional[int] = None,
+                      n_pages: Optional[int] = None) -> Tuple[str, int]:
+    # Text of pages [first, last) (0-based; last=None reads to the end) and the document's
+    # page count, 0 if the backend can't tell. Pass n_pages from an earlier call to skip pdfinfo.
+    if PDFTOTEXT_PATH:
+        try:
+            n = _pdf_page_count(data) if n_pages is None else n_pages
+            full = _pdftotext_text(data, first, last, n)
+            if full.strip():
+                return full, n
+        except Exception:
+            pass
+    if PYMUPDF_ENABLED:
+        try:
+            pymupdf = importlib.import_module(PYMUPDF_MODULE)
+            with pymupdf.open(stream=data, filetype="pdf") as doc:
+                stop = doc.page_count if last is None else min(last, doc.page_count)
+                # sort=True rebuilds visual lines; plain "text" puts every table cell on its own
+                # line, which the single-line lab patterns can't match.
+                return "\n".join(doc.load_page(i).get_text("text", sort=True) for i in range(first, stop)), doc.page_count
+        except Exception:
+            pass
+    if not PDFPLUMBER_ENABLED:
+        return "", 0
+    import pdfplumber
+    # laparams=None keeps pdfminer's layout analysis off; extract_text_simple skips word clustering.
+    with pdfplumber.open(io.BytesIO(data), laparams=None) as pdf:
+        return "\n".join(page.extract_text_simple() or "" for page in pdf.pages[first:last]), len(pdf.pages)
 
-def parse_pdf_bytes_return_text(pdf_bytes) -> Tuple[Dict[str, float], str]:
-    out: Dict[str, float] = {}
-    full = ""
-    try:
-        with pdfplumber.open(pdf_bytes) as pdf:
-            texts = [page.extract_text() or "" for page in pdf.pages]
-            full = "\n".join(texts)
-    except Exception:
-        return out, full
 
-    text = re.sub(r"[^\S\r\n]+", " ", full, flags=re.M).replace("\u00b5", "µ")
+def _scan_fields(text: str, keys: Iterable[str] = STRICT_PATTERNS) -> Dict[str, Tuple[int, Any]]:
+    # First match per field with its rank, lower wins: 0/1 for the AST reference range (in
+    # _ULN_RANGE_RE order), 2 for the strict pattern, 3 for the loose one.
+    out: Dict[str, Tuple[int, Any]] = {}
 
     # --- ULN AST: prefer capturing the upper value from a range like "3 - 50" on the AST line ---
-    if "uln_ast" not in out:
-        ULN_RANGE_PATTERNS = [
-            r"(?:AST|SGOT)[^\n]*?U/?L[^\n]*?(\d{1,3})\s*[-–‐]\s*(\d{2,3})",  # ...U/L ... 3 - 50
-            r"(?:AST|SGOT)[^\n]*?(?:ref(?:erence)?\s*(?:range|interval)|bio\.?\s*ref.*?|range)[^\n]*?(\d{1,3})\s*[-–‐]\s*(\d{2,3})"
-        ]
-        for pat in ULN_RANGE_PATTERNS:
-            m = re.search(pat, text, flags=re.I)
+    if "uln_ast" in keys:
+        for rank, pat in enumerate(_ULN_RANGE_RE):
+            m = pat.search(text)
             if m:
                 lo_v, hi_v = int(m.group(1)), int(m.group(2))
-                out["uln_ast"] = float(max(lo_v, hi_v))
+                out["uln_ast"] = (rank, float(max(lo_v, hi_v)))
                 break
 
     def search_and_set(key):
         # Don't overwrite uln_ast if we already captured a range
         if key == "uln_ast" and "uln_ast" in out:
             return
-        m = re.search(STRICT_PATTERNS[key], text, flags=re.I)
+        rank, m = 2, _STRICT_RE[key].search(text)
         if not m:
-            m = re.search(LOOSE_PATTERNS[key], text, flags=re.I)
+            rank, m = 3, _LOOSE_RE[key].search(text)
         if m:
             try:
-                out[key] = m.group(1).strip()
+                out[key] = (rank, m.group(1).strip())
             except Exception:
                 pass
 
-    for k in STRICT_PATTERNS.keys():
+    for k in keys:
         search_and_set(k)
 
+    return out
+
+
+def _normalize_text(full: str) -> str:
+    # Collapse each line's whitespace runs (tabs, NBSP, thin spaces, ...) to one space and
+    # trim it; str.split/join does this in C, about twice as fast as the equivalent regex.
+    return "\n".join(" ".join(line.split()) for line in full[:_MAX_SCAN_CHARS].splitlines())
+
+
+def parse_pdf_bytes_return_text(pdf_bytes) -> Tuple[Dict[str, float], str]:
+    out: Dict[str, float] = {}
+    full = ""
+    try:
+        data = pdf_bytes.read()
+        full, n_pages = _extract_pdf_text(data, 0, _FIRST_PAGES)
+        text = _normalize_text(full)
+        found = _scan_fields(text)
+    except Exception:
+        return {}, full
+
+    # Read further pages in doubling batches only while labs are missing; stop at the end of
+    # the document or once there is more text than the scan would look at. Each batch's text
+    # is scanned on its own for fields that are missing or matched only by a weaker pattern;
+    # a hit replaces an earlier one only if its pattern is stronger, as if the whole text were scanned.
+    lo, step = _FIRST_PAGES, _FIRST_PAGES
+    while (any(k not in found for k in _LAB_FIELDS) and len(full) < _MAX_SCAN_CHARS
+           and (not n_pages or lo < n_pages)):
+        hi = lo + step if n_pages else None
+        try:
+            rest, _ = _extract_pdf_text(data, lo, hi, n_pages)
+        except Exception:
+            # A bad later page doesn't cost the fields already found
+            break
+        if rest:
+            new = _normalize_text(rest[:_MAX_SCAN_CHARS - len(full)])
+            full, text = full + "\n" + rest, text + "\n" + new
+            weak = [k for k in STRICT_PATTERNS if found.get(k, (4,))[0] > (0 if k == "uln_ast" else 2)]
+            for k, hit in _scan_fields(new, weak).items():
+                if hit[0] < found.get(k, (4,))[0]:
+                    found[k] = hit
+        if hi is None:
+            break
+        lo, step = hi, step * 2
+    out = {k: v for k, (_, v) in found.items()}
+
     # Albumin g/L → g/dL if unit nearby indicates g/L
     if "albumin_gdl" in out:
         try:
             out["albumin_gdl"] = float(out["albumin_gdl"])
         except Exception:
             out["albumin_gdl"] = None
-        m = re.search(r"Albumin[^\n]{0,40}?(\d+(?:\.\d+)?)\s*(g/?dL|g/?L)", text, flags=re.I)
+        m = _ALBUMIN_UNIT_RE.search(text)
         if m and "g/L" in m.group(2).replace(" ", "").lower():
             if isinstance(out["albumin_gdl"], (int, float)):
                 out["albumin_gdl"] = out["albumin_gdl"] / 10.0
@@ -285,17 +297,97 @@ def parse_pdf_bytes_return_text(pdf_bytes) -> Tuple[Dict[str, float], str]:
 
     return out, full
 
+
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60, max_entries=16)
+def _cached_parse_pdf(file_bytes: bytes) -> Tuple[Dict[str, float], str]:
+    # Keyed on the raw bytes, so reruns with the same upload skip text extraction entirely.
+    return parse_pdf_bytes_return_text(io.BytesIO(file_bytes))
+
+# ---------- Single-patient pipeline ----------
+@st.cache_data(show_spinner=False, max_entries=256)
+def compute_all(age, bmi, waist_cm, tg, ggt, ast, alt, uln_ast, platelets, albumin, diab_flag) -> Dict[str, object]:
+    # Every score for one set of inputs; Calculate with unchanged inputs is a cache hit.
+    fli = fli_score(tg, bmi, ggt, waist_cm)
+    fli_cat, fli_act, fli_color = fli_category_action(fli)
+    fib4 = fib4_score(age, ast, alt, platelets)
+    fib4_cat, fib4_color = categorize_fib4(fib4)
+    apri = apri_score(ast, uln_ast, platelets)
+    apri_cat, apri_color = categorize_apri(apri)
+    nfs = nfs_score(age, bmi, diab_flag, ast, alt, platelets, albumin)
+    nfs_cat, nfs_color = categorize_nfs(nfs)
+    fib4_sub = subscore_fib4(fib4)
+    apri_sub = subscore_apri(apri)
+    nfs_sub = subscore_nfs(nfs)
+    return {
+        "fli": fli, "fli_cat": fli_cat, "fli_act": fli_act, "fli_color": fli_color,
+        "fib4": fib4, "fib4_cat": fib4_cat, "fib4_color": fib4_color,
+        "apri": apri, "apri_cat": apri_cat, "apri_color": apri_color,
+        "nfs": nfs, "nfs_cat": nfs_cat, "nfs_color": nfs_color,
+        "fib4_sub": fib4_sub, "apri_sub": apri_sub, "nfs_sub": nfs_sub,
+        "liver100": combine_liver_health(fib4_sub, apri_sub, nfs_sub),
+    }
+
+# ---------- PDF report ----------
+_PDF_HEADER_ROW = ["Metric", "Value", "Interpretation / Action"]
+
+@st.cache_resource(show_spinner=False)
+def _pdf_styles():
+    # Once per process: module-level code in this script re-executes on every rerun.
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import TableStyle
+
+    table_style = TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#eeeeee')),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.black),
+        ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.white, colors.HexColor('#fafafa')]),
+    ])
+    return getSampleStyleSheet(), table_style
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_pdf(name: str, sex: str, age: int, results: Tuple[Tuple[str, str, str], ...]) -> bytes:
+    # results holds the (metric, value, interpretation) table rows, all strings, so the
+    # cache key is cheap to hash and an unchanged report skips ReportLab entirely.
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+
+    styles, table_style = _pdf_styles()
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4, title="Liver Health Report")
+
+    pinfo = f"<b>Patient:</b> {name or '—'} &nbsp;&nbsp; <b>Sex:</b> {sex} &nbsp;&nbsp; <b>Age:</b> {age} years"
+    rows = [_PDF_HEADER_ROW]
+    rows.extend(list(r) for r in results)
+    tbl = Table(rows, hAlign='LEFT', colWidths=[130, 100, 260])
+    tbl.setStyle(table_style)
+
+    story = [
+        Paragraph("<b>Liver Health Report</b>", styles["Title"]),
+        Spacer(1, 8),
+        Paragraph(pinfo, styles["Normal"]),
+        Spacer(1, 10),
+        tbl,
+        Spacer(1, 12),
+        Paragraph("<b>Disclaimer:</b> This report is for screening and educational purposes only and is not a substitute for professional medical advice.", styles['Italic']),
+    ]
+
+    doc.build(story)
+    return buf.getvalue()
+
 # ---------- App UI ----------
 st.title("Liver Health Assessment Tool — Validated Option A (with PDF)")
 st.caption("Uses FLI (steatosis screening) and fibrosis scores (FIB-4, APRI, NFS). Liver Health 0–100 is based on fibrosis only.")
 
 with st.expander("Upload Lab PDF (beta: text-based PDFs only)"):
     if not PDF_ENABLED:
-        st.warning("PDF parsing requires 'pdfplumber'. Add it to requirements.txt.")
+        st.warning("PDF parsing requires 'pymupdf' or 'pdfplumber'. Add one to requirements.txt.")
     else:
         up = st.file_uploader("Upload a lab PDF (text-based, not scanned)", type=["pdf"])
         if up is not None:
-            data, raw_text = parse_pdf_bytes_return_text(up)
+            data, raw_text = _cached_parse_pdf(up.getvalue())
             if data:
                 st.success("Parsed these fields from the PDF (you can edit below):")
                 # Round numeric values only for display
@@ -321,45 +413,40 @@ with st.expander("Upload Lab PDF (beta: text-based PDFs only)"):
                 st.text(raw_text if raw_text else "No text extracted.")
 
 with st.expander("Single-Patient Assessment", expanded=True):
-    col0, col1, col2, col3 = st.columns(4)
-    with col0:
-        name = st.text_input("Patient Name", value=st.session_state.get("name", ""), key="name")
-        sex = st.selectbox("Sex", ["M", "F"], index=(0 if st.session_state.get("sex", "M") == "M" else 1), key="sex")
-        age = st.number_input("Age (years)", min_value=0, max_value=120, value=int(st.session_state.get("age", 40)), step=1, key="age")
-    with col1:
-        bmi = st.number_input("BMI (kg/m²)", min_value=10.0, max_value=80.0, value=float(st.session_state.get("bmi", 27.0)), step=0.1, key="bmi")
-        waist_cm = st.number_input("Waist circumference (cm)", min_value=40.0, max_value=200.0, value=float(st.session_state.get("waist", 95.0)), step=0.5, key="waist")
-    with col2:
-        tg = st.number_input("Triglycerides (mg/dL)", min_value=10.0, max_value=2000.0, value=float(st.session_state.get("tg", 160.0)), step=1.0, key="tg")
-        ggt = st.number_input("GGT (U/L)", min_value=1.0, max_value=2000.0, value=float(st.session_state.get("ggt", 45.0)), step=1.0, key="ggt")
-        ast = st.number_input("AST (U/L)", min_value=1.0, max_value=5000.0, value=float(st.session_state.get("ast", 35.0)), step=0.5, key="ast")
-        alt = st.number_input("ALT (U/L)", min_value=1.0, max_value=5000.0, value=float(st.session_state.get("alt", 30.0)), step=0.5, key="alt")
-    with col3:
-        uln_ast = st.number_input("ULN AST (U/L)", min_value=10.0, max_value=100.0, value=float(st.session_state.get("uln_ast", 40.0)), step=1.0,
-                                   help="Upper limit of normal for your lab", key="uln_ast")
-        platelets = st.number_input("Platelets (10⁹/L)", min_value=20.0, max_value=1000.0, value=float(st.session_state.get("platelets", 230.0)), step=1.0, key="platelets")
-        albumin = st.number_input("Albumin (g/dL)", min_value=1.0, max_value=6.0, value=float(st.session_state.get("albumin", 4.2)), step=0.1, key="albumin")
-        diab_ifg = st.selectbox("Diabetes / IFG", ["No", "Yes"], index=(1 if str(st.session_state.get("diab", "No")) in ["1", "Yes"] else 0), key="diab")
+    # Widgets inside a form don't rerun the script on every edit; only Calculate submits them.
+    with st.form("patient_form"):
+        col0, col1, col2, col3 = st.columns(4)
+        with col0:
+            name = st.text_input("Patient Name", value=st.session_state.get("name", ""), key="name")
+            sex = st.selectbox("Sex", ["M", "F"], index=(0 if st.session_state.get("sex", "M") == "M" else 1), key="sex")
+            age = st.number_input("Age (years)", min_value=0, max_value=120, value=int(st.session_state.get("age", 40)), step=1, key="age")
+        with col1:
+            bmi = st.number_input("BMI (kg/m²)", min_value=10.0, max_value=80.0, value=float(st.session_state.get("bmi", 27.0)), step=0.1, key="bmi")
+            waist_cm = st.number_input("Waist circumference (cm)", min_value=40.0, max_value=200.0, value=float(st.session_state.get("waist", 95.0)), step=0.5, key="waist")
+        with col2:
+            tg = st.number_input("Triglycerides (mg/dL)", min_value=10.0, max_value=2000.0, value=float(st.session_state.get("tg", 160.0)), step=1.0, key="tg")
+            ggt = st.number_input("GGT (U/L)", min_value=1.0, max_value=2000.0, value=float(st.session_state.get("ggt", 45.0)), step=1.0, key="ggt")
+            ast = st.number_input("AST (U/L)", min_value=1.0, max_value=5000.0, value=float(st.session_state.get("ast", 35.0)), step=0.5, key="ast")
+            alt = st.number_input("ALT (U/L)", min_value=1.0, max_value=5000.0, value=float(st.session_state.get("alt", 30.0)), step=0.5, key="alt")
+        with col3:
+            uln_ast = st.number_input("ULN AST (U/L)", min_value=10.0, max_value=100.0, value=float(st.session_state.get("uln_ast", 40.0)), step=1.0,
+                                       help="Upper limit of normal for your lab", key="uln_ast")
+            platelets = st.number_input("Platelets (10⁹/L)", min_value=20.0, max_value=1000.0, value=float(st.session_state.get("platelets", 230.0)), step=1.0, key="platelets")
+            albumin = st.number_input("Albumin (g/dL)", min_value=1.0, max_value=6.0, value=float(st.session_state.get("albumin", 4.2)), step=0.1, key="albumin")
+            diab_ifg = st.selectbox("Diabetes / IFG", ["No", "Yes"], index=(1 if str(st.session_state.get("diab", "No")) in ["1", "Yes"] else 0), key="diab")
+        submitted = st.form_submit_button("Calculate")
 
     diab_flag = 1 if diab_ifg == "Yes" else 0
 
     pdf_bytes = None
 
-    if st.button("Calculate"):
-        fli = fli_score(tg, bmi, ggt, waist_cm)
-        fli_cat, fli_act, fli_color = fli_category_action(fli)
-
-        fib4 = fib4_score(age, ast, alt, platelets)
-        fib4_cat, fib4_color = categorize_fib4(fib4)
-        apri = apri_score(ast, uln_ast, platelets)
-        apri_cat, apri_color = categorize_apri(apri)
-        nfs = nfs_score(age, bmi, diab_flag, ast, alt, platelets, albumin)
-        nfs_cat, nfs_color = categorize_nfs(nfs)
-
-        fib4_sub = subscore_fib4(fib4)
-        apri_sub = subscore_apri(apri)
-        nfs_sub = subscore_nfs(nfs)
-        liver100 = combine_liver_health(fib4_sub, apri_sub, nfs_sub)
+    if submitted:
+        res = compute_all(age, bmi, waist_cm, tg, ggt, ast, alt, uln_ast, platelets, albumin, diab_flag)
+        fli, fli_cat, fli_act, fli_color = res["fli"], res["fli_cat"], res["fli_act"], res["fli_color"]
+        fib4, fib4_cat, fib4_color = res["fib4"], res["fib4_cat"], res["fib4_color"]
+        apri, apri_cat, apri_color = res["apri"], res["apri_cat"], res["apri_color"]
+        nfs, nfs_cat, nfs_color = res["nfs"], res["nfs_cat"], res["nfs_color"]
+        liver100 = res["liver100"]
 
         st.subheader("Results")
 
@@ -384,71 +471,25 @@ with st.expander("Single-Patient Assessment", expanded=True):
         st.markdown("**Fibrosis-based Liver Health Score (0–100; higher is better)**")
         l_text = None
         if liver100 is not None:
-            if liver100 >= 85:
-                l_color = "#2e7d32"
-                l_text = "Low probability of advanced fibrosis — routine monitoring."
-            elif liver100 >= 60:
-                l_color = "#f9a825"
-                l_text = "Indeterminate probability — consider elastography (FibroScan)."
-            else:
-                l_color = "#c62828"
-                l_text = "High probability of advanced fibrosis — hepatology referral, imaging/workup."
+            b = band_index("liver100", liver100)
+            l_text, l_color = THRESHOLDS["liver100"]["labels"][b], THRESHOLDS["liver100"]["colors"][b]
             color_box(f"Liver Health: {liver100:.1f} / 100  •  {l_text}", l_color)
         else:
             st.info("Insufficient inputs to compute the fibrosis-based Liver Health Score.")
 
         # ---------- Build PDF ----------
         if REPORTLAB_ENABLED:
-            buf = io.BytesIO()
-            doc = SimpleDocTemplate(buf, pagesize=A4, title="Liver Health Report")
-            styles = getSampleStyleSheet()
-            story = []
-
-            title = f"<b>Liver Health Report</b>"
-            story.append(Paragraph(title, styles["Title"]))
-            story.append(Spacer(1, 8))
-
-            pinfo = f"<b>Patient:</b> {name or '—'} &nbsp;&nbsp; <b>Sex:</b> {sex} &nbsp;&nbsp; <b>Age:</b> {int(age)} years"
-            story.append(Paragraph(pinfo, styles["Normal"]))
-            story.append(Spacer(1, 10))
-
             # Table of results
-            rows = [["Metric", "Value", "Interpretation / Action"]]
-            rows.append(["FLI", f"{fli:.1f}" if fli is not None else "—", (f"{fli_cat}. {fli_act}" if fli is not None else "Insufficient inputs")])
-            rows.append(["FIB-4", f"{fib4:.3f}" if fib4 is not None else "—", (
-                "Advanced fibrosis unlikely; routine monitoring." if fib4 is not None and fib4 <= 1.3 else (
-                "Indeterminate; consider elastography (FibroScan)." if fib4 is not None and fib4 < 2.67 else (
-                "Advanced fibrosis likely; refer to hepatology." if fib4 is not None else "Insufficient inputs"
-            ))])
-            rows.append(["APRI", f"{apri:.3f}" if apri is not None else "—", (
-                "Significant fibrosis unlikely." if apri is not None and apri < 0.5 else (
-                "Indeterminate; consider elastography / repeat testing." if apri is not None and apri < 1.0 else (
-                "Advanced fibrosis likely; specialist referral." if apri is not None else "Insufficient inputs"
-            ))])
-            rows.append(["NFS", f"{nfs:.3f}" if nfs is not None else "—", (
-                "Advanced fibrosis unlikely." if nfs is not None and nfs < -1.455 else (
-                "Indeterminate; consider elastography / specialist assessment." if nfs is not None and nfs <= 0.675 else (
-                "Advanced fibrosis likely; specialist referral." if nfs is not None else "Insufficient inputs"
-            ))])
-            rows.append(["Liver Health (0–100)", f"{liver100:.1f}" if liver100 is not None else "—", (l_text or "Insufficient inputs")])
-
-            tbl = Table(rows, hAlign='LEFT', colWidths=[130, 100, 260])
-            tbl.setStyle(TableStyle([
-                ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#eeeeee')),
-                ('TEXTCOLOR', (0,0), (-1,0), colors.black),
-                ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-                ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.white, colors.HexColor('#fafafa')]),
-            ]))
-            story.append(tbl)
-
-            story.append(Spacer(1, 12))
-            story.append(Paragraph("<b>Disclaimer:</b> This report is for screening and educational purposes only and is not a substitute for professional medical advice.", styles['Italic']))
-
-            doc.build(story)
-            pdf_bytes = buf.getvalue()
-            buf.close()
+            rows = [("FLI", f"{fli:.1f}" if fli is not None else "—", (f"{fli_cat}. {fli_act}" if fli is not None else "Insufficient inputs"))]
+            for label, kind, x in (("FIB-4", "fib4", fib4), ("APRI", "apri", apri), ("NFS", "nfs", nfs)):
+                rows.append((label, f"{x:.3f}" if x is not None else "—",
+                             THRESHOLDS[kind]["pdf_text"][band_index(kind, x)] if x is not None else "Insufficient inputs"))
+            rows.append(("Liver Health (0–100)", f"{liver100:.1f}" if liver100 is not None else "—", (l_text or "Insufficient inputs")))
+
+            try:
+                pdf_bytes = build_pdf(name, sex, int(age), tuple(rows))
+            except ImportError:  # installed but broken; find_spec alone can't tell
+                st.error("reportlab is not available. Please ensure it's added to requirements.txt.")
         else:
             st.error("reportlab is not available. Please ensure it's added to requirements.txt.")
 
@@ -464,63 +505,23 @@ with st.expander("Batch Processing (CSV upload)"):
     st.markdown("Template columns (case-insensitive): **name, age, sex, bmi, waist_cm, tg_mgdl, ggt_ul, ast_ul, alt_ul, uln_ast, platelets, albumin_gdl, diab_ifg**")
     file = st.file_uploader("Upload CSV", type=["csv"], key="csvu")
     if file is not None:
-        df = pd.read_csv(file)
-        rename_map = {
-            'name': 'name', 'patientname': 'name',
-            'age': 'age', 'sex': 'sex', 'bmi': 'bmi', 'waist_cm': 'waist_cm', 'waist': 'waist_cm',
-            'tg_mgdl': 'tg_mgdl', 'tg': 'tg_mgdl', 'triglycerides': 'tg_mgdl',
-            'ggt_ul': 'ggt_ul', 'ggt': 'ggt_ul',
-            'ast_ul': 'ast_ul', 'ast': 'ast_ul',
-            'alt_ul': 'alt_ul', 'alt': 'alt_ul',
-            'uln_ast': 'uln_ast',
-            'platelets': 'platelets',
-            'albumin_gdl': 'albumin_gdl', 'albumin': 'albumin_gdl',
-            'diab_ifg': 'diab_ifg', 'diabetes': 'diab_ifg'
-        }
-        df = df.rename(columns={c: rename_map.get(str(c).strip().lower(), c) for c in df.columns})
-
-        results = []
-        for _, r in df.iterrows():
-            try:
-                age = float(r.get("age", float("nan")))
-                bmi = float(r.get("bmi", float("nan")))
-                waist = float(r.get("waist_cm", float("nan")))
-                tg = float(r.get("tg_mgdl", float("nan")))
-                ggt = float(r.get("ggt_ul", float("nan")))
-                ast = float(r.get("ast_ul", float("nan")))
-                alt = float(r.get("alt_ul", float("nan")))
-                uln = float(r.get("uln_ast", 40.0)) if pd.notna(r.get("uln_ast")) else 40.0
-                plate = float(r.get("platelets", 250.0)) if pd.notna(r.get("platelets")) else 250.0
-                alb = float(r.get("albumin_gdl", float("nan"))) if pd.notna(r.get("albumin_gdl")) else None
-                diab = int(r.get("diab_ifg", 0)) if pd.notna(r.get("diab_ifg")) else 0
-            except Exception:
-                age = bmi = waist = tg = ggt = ast = alt = uln = plate = alb = None
-                diab = 0
-
-            fli = fli_score(tg, bmi, ggt, waist)
-            fli_cat, fli_act, _ = fli_category_action(fli)
-            fib4 = fib4_score(age, ast, alt, plate)
-            apri = apri_score(ast, uln, plate)
-            nfs = nfs_score(age, bmi, diab, ast, alt, plate, alb) if alb is not None else None
-            fib4_sub = subscore_fib4(fib4)
-            apri_sub = subscore_apri(apri)
-            nfs_sub = subscore_nfs(nfs) if nfs is not None else None
-            liver100 = combine_liver_health(fib4_sub, apri_sub, nfs_sub)
-
-            results.append({
-                "name": r.get("name"), "age": r.get("age"), "sex": r.get("sex"), "bmi": r.get("bmi"), "waist_cm": r.get("waist_cm"),
-                "tg_mgdl": r.get("tg_mgdl"), "ggt_ul": r.get("ggt_ul"),
-                "ast_ul": r.get("ast_ul"), "alt_ul": r.get("alt_ul"), "uln_ast": r.get("uln_ast"),
-                "platelets": r.get("platelets"), "albumin_gdl": r.get("albumin_gdl"), "diab_ifg": r.get("diab_ifg"),
-                "FLI": None if fli is None else round(fli, 1), "FLI_category": fli_cat, "FLI_action": fli_act,
-                "FIB4": None if fib4 is None else round(fib4, 3),
-                "APRI": None if apri is None else round(apri, 3),
-                "NFS": None if nfs is None else round(nfs, 3),
-                "LiverHealth100": None if liver100 is None else round(liver100, 1)
-            })
-        out = pd.DataFrame(results)
-        st.dataframe(out, use_container_width=True)
-        st.download_button("Download results CSV", data=out.to_csv(index=False).encode("utf-8"),
-                           file_name="nafld_results.csv", mime="text/csv")
+        from liver_batch import CSV_CHUNK_ROWS, GZIP_MIN_ROWS, PREVIEW_ROWS, read_batch_csv, score_batch
+
+        df = read_batch_csv(file)
+        out = score_batch(df)
+        # The browser only gets a preview; the download below carries every row.
+        st.dataframe(out.head(PREVIEW_ROWS), use_container_width=True)
+        if len(out) > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS:,} of {len(out):,} rows.")
+        # Write straight into one bytes buffer (no intermediate str) in row chunks; gzip large cohorts.
+        buf = io.BytesIO()
+        if len(out) >= GZIP_MIN_ROWS:
+            out.to_csv(buf, index=False, chunksize=CSV_CHUNK_ROWS, compression={"method": "gzip", "compresslevel": 6})
+            st.download_button("Download results CSV (gzip)", data=buf.getvalue(),
+                               file_name="nafld_results.csv.gz", mime="application/gzip")
+        else:
+            out.to_csv(buf, index=False, chunksize=CSV_CHUNK_ROWS, encoding="utf-8")
+            st.download_button("Download results CSV", data=buf.getvalue(),
+                               file_name="nafld_results.csv", mime="text/csv")
 
 st.caption("Disclaimer: For screening and educational purposes only. Not a substitute for professional medical advice.")